@@ -29,11 +29,33 @@ from osgeo import gdal, osr
 import os
 import tempfile
 
-from celery_tiles.tasks import TileRenderer
+from celery_tiles.tasks import JobTileRenderer
+from celery_tiles.jobs import JOB_DIR_SETTING, job_dir, save_job, tile_path
+from celery_tiles.colors import palette, parse_ramp
 from celery_tiles.utils import GlobalMercator
 
 version = "0.3"
 
+def route(cost, count, **options):
+    """Returns the options for apply_async() of a task which reads cost
+    pixels from the source for its count tiles. Tasks reading more than
+    heavy_cost times the pixels of a tile per tile are sent to the
+    heavy_queue."""
+    tilesize = options.get('tilesize')
+    heavy_cost = options.get('heavy_cost')
+    if heavy_cost is None:
+        heavy_cost = 16
+    if options.get('heavy_queue') and cost > heavy_cost * count * tilesize * tilesize:
+        queue, priority = options.get('heavy_queue'), options.get('heavy_priority')
+    else:
+        queue, priority = options.get('queue'), options.get('priority')
+    routing = {}
+    if queue:
+        routing['queue'] = queue
+    if priority is not None:
+        routing['priority'] = priority
+    return routing
+
 def prepare(inputfile, logger, exc, **options):
     gdal.AllRegister()
     # Spatial Reference System of tiles
@@ -57,6 +79,34 @@ def prepare(inputfile, logger, exc, **options):
     if not out_drv:
         raise exc("The '%s' driver was not found, is it available in this GDAL build?", options.get('format'))
 
+    # Additional variants are rendered from the same reads into their own
+    # output directories.
+    variants = [{'output': os.path.abspath(output), 'format': options.get('format'), 'tilesize': options.get('tilesize')}]
+    for spec in options.get('variant') or []:
+        parts = spec.split(':', 2)
+        try:
+            variant = {'format': parts[0].upper(), 'tilesize': int(parts[1])}
+        except (IndexError, ValueError):
+            raise exc("Invalid variant '%s', expected FORMAT:TILESIZE[:DIR]." % spec)
+        # GIF only supports single band images, which tiles never are.
+        if variant['format'] not in ('PNG', 'JPEG'):
+            raise exc("Invalid format '%s' in variant '%s', expected PNG or JPEG." % (parts[0], spec))
+        if variant['tilesize'] < 1:
+            raise exc("Invalid tilesize %d in variant '%s'." % (variant['tilesize'], spec))
+        if len(parts) > 2:
+            variant['output'] = os.path.abspath(parts[2])
+        else:
+            variant['output'] = "%s-%d-%s" % (variants[0]['output'], variant['tilesize'], variant['format'].lower())
+        if not gdal.GetDriverByName(variant['format']):
+            raise exc("The '%s' driver was not found, is it available in this GDAL build?" % variant['format'])
+        if os.path.exists(variant['output']):
+            if not options.get('resume'):
+                raise exc('Output %s already exists and resume is not enabled, aborting!' % variant['output'])
+        elif not options.get('dry_run'):
+            os.makedirs(variant['output'])
+        logger.info("Variant: %s %dpx in %s", variant['format'], variant['tilesize'], variant['output'])
+        variants.append(variant)
+
     # Open the input file
     in_ds = gdal.Open(inputfile, gdal.GA_ReadOnly)
 
@@ -72,9 +122,17 @@ def prepare(inputfile, logger, exc, **options):
     if in_ds.RasterCount == 0:
         raise exc("Input file '%s' has no raster band" % inputfile)
 
-    if in_ds.GetRasterBand(1).GetRasterColorTable():
-        # TODO: Process directly paletted dataset by generating VRT in memory
-        raise exc("Please convert %s to RGB/RGBA with gdal_translate." % inputfile)
+    # Colors for single band input are applied by the workers per tile
+    colormap = None
+    if options.get('color_ramp'):
+        try:
+            colormap = parse_ramp(options.get('color_ramp'))
+        except (IOError, ValueError) as e:
+            raise exc("Unable to read color ramp %s: %s" % (options.get('color_ramp'), e))
+        logger.info("Color ramp: %s", options.get('color_ramp'))
+    elif in_ds.GetRasterBand(1).GetRasterColorTable():
+        colormap = palette(in_ds.GetRasterBand(1).GetRasterColorTable())
+        logger.info("Color table: %d entries", len(colormap['palette']))
 
     # Get NODATA value
     in_nodata = []
@@ -150,7 +208,7 @@ def prepare(inputfile, logger, exc, **options):
             os.unlink(tempfilename)
 
             # set NODATA_VALUE metadata
-            out_ds.SetMetadataItem('NODATA_VALUES','%i %i %i' % (in_nodata[0],in_nodata[1],in_nodata[2]))
+            out_ds.SetMetadataItem('NODATA_VALUES',' '.join('%i' % n for n in in_nodata))
 
             #logger.info("Modified warping result saved into 'tiles1.vrt'")
             #open("tiles1.vrt","w").write(s)
@@ -193,6 +251,9 @@ def prepare(inputfile, logger, exc, **options):
         dataBandsCount = out_ds.RasterCount
     logger.info("dataBandsCount: %s", dataBandsCount)
 
+    if colormap and dataBandsCount != 1:
+        raise exc("Colors can only be applied to input with a single band, %s has %d." % (inputfile, dataBandsCount))
+
     # Read the georeference
 
     out_gt = out_ds.GetGeoTransform()
@@ -244,24 +305,123 @@ def prepare(inputfile, logger, exc, **options):
         logger.info("This is only a dry-run, stopping before any tasks are dispatched ...")
 
     workerfile = os.path.abspath("%s.worker" % inputfile)
-    out_ds.GetDriver().CreateCopy(workerfile, out_ds)
-    tr = TileRenderer()
+    if not options.get('tiled'):
+        out_ds.GetDriver().CreateCopy(workerfile, out_ds)
+    elif not options.get('dry_run'):
+        if not hasattr(gdal, 'Warp'):
+            raise exc("Converting to a tiled input file requires GDAL >= 2.1.")
+        # Warp the input once onto the grid of the tiles at the maximal zoom
+        # level, so each block of the GeoTIFF matches exactly one tile.
+        tminx, tminy, tmaxx, tmaxy = tminmax[tmaxz]
+        bounds = mercator.TileBounds(tminx, tminy, tmaxz)[:2] + mercator.TileBounds(tmaxx, tmaxy, tmaxz)[2:]
+        logger.info("Converting to tiled GeoTIFF: %s", workerfile)
+        tilesize = options.get('tilesize')
+        datatype = out_ds.GetRasterBand(1).DataType
+        if datatype in (gdal.GDT_Byte, gdal.GDT_UInt16):
+            alpha = {'dstAlpha': True}
+        else:
+            # GDAL only uses Byte and UInt16 bands as alpha, so the area
+            # around the input is marked as NODATA for other data types.
+            nodata = out_ds.GetRasterBand(1).GetNoDataValue()
+            if nodata is None:
+                nodata = {
+                    gdal.GDT_Int16: -32768,
+                    gdal.GDT_Int32: -2147483648,
+                    gdal.GDT_UInt32: 4294967295,
+                }.get(datatype, float('nan'))
+            logger.info("Using NODATA %s for the tiled GeoTIFF", nodata)
+            alpha = {'dstNodata': nodata}
+        tiled_ds = gdal.Warp(workerfile, out_ds,
+            format='GTiff',
+            outputBounds=bounds,
+            xRes=mercator.Resolution(tmaxz),
+            yRes=mercator.Resolution(tmaxz),
+            srcAlpha=out_ds.RasterCount > dataBandsCount,
+            resampleAlg=gdal.GRA_NearestNeighbour,
+            creationOptions=['TILED=YES', 'BLOCKXSIZE=%d' % tilesize, 'BLOCKYSIZE=%d' % tilesize, 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'],
+            **alpha)
+        if not tiled_ds:
+            raise exc("Unable to convert %s to a tiled GeoTIFF." % inputfile)
+        # One internal overview for each lower zoom level
+        levels = [2**i for i in range(1, tmaxz-tminz+1)]
+        logger.info("Building overviews: %s", levels)
+        gdal.SetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE', str(tilesize))
+        try:
+            res = tiled_ds.BuildOverviews('NEAREST', levels)
+        finally:
+            gdal.SetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE', None)
+        if res != gdal.CE_None:
+            raise exc("Unable to build overviews for %s: %s" % (workerfile, gdal.GetLastErrorMsg()))
+        tiled_ds = None
+        out_ds = gdal.Open(workerfile, gdal.GA_ReadOnly)
+
+    # All parameters shared by the tasks are stored once in a job
+    # descriptor, the tasks only carry the job ID and tile coordinates.
+    job = {
+        'source': workerfile,
+        'variants': variants,
+        'bands': dataBandsCount,
+        'optimize': False,
+        'overviews': bool(options.get('tiled')),
+        'colormap': colormap,
+        'max_memory': (options.get('max_memory') or 0) * 1024 * 1024,
+    }
+    jtr = JobTileRenderer()
+    job_id = None
+    if not jtr.app.conf.get(JOB_DIR_SETTING):
+        logger.warning("%s is not set, the job is stored in %s which is only accessible to workers on this node.", JOB_DIR_SETTING, job_dir(jtr.app))
+    if not options.get('dry_run'):
+        try:
+            job_id = save_job(job_dir(jtr.app), job)
+        except (IOError, OSError) as e:
+            raise exc("Unable to store job in %s: %s" % (job_dir(jtr.app), e))
+        logger.info("Job: %s", job_id)
+
+    # Workers read each tile once at the largest tilesize of all variants
+    readsize = max(variant['tilesize'] for variant in variants)
+
+    def read_cost(tx, ty, tz):
+        # Number of source pixels the worker reads for this tile
+        if job['overviews']:
+            rb, wb = jtr.geo_query(out_ds, *mercator.TileBounds(tx, ty, tz), querysize=readsize)
+            return wb[2] * wb[3]
+        rb, wb = jtr.geo_query(out_ds, *mercator.TileBounds(tx, ty, tz))
+        return rb[2] * rb[3]
+
+    batch = max(1, options.get('batch') or 1)
     for tz in range (tmaxz, tminz-1, -1):
         tminx, tminy, tmaxx, tmaxy = tminmax[tz]
         for tx in range(tminx, tmaxx+1):
-            tiledir = os.path.abspath(os.path.join(output, str(tz), str(tx)))
-            if not os.path.exists(tiledir) and not options.get('dry_run'):
-                logger.debug("Creating tile directory: %s", tiledir)
-                os.makedirs(tiledir)
+            for variant in variants:
+                tiledir = os.path.join(variant['output'], str(tz), str(tx))
+                if not os.path.exists(tiledir) and not options.get('dry_run'):
+                    logger.debug("Creating tile directory: %s", tiledir)
+                    os.makedirs(tiledir)
+            # Tiles of one column are dispatched together as ranges of up to
+            # batch tiles, so workers can pipeline reading and encoding
+            # between them. Existing tiles split the ranges on resume.
+            ranges = [[]]
             for ty in range(tmaxy, tminy-1, -1):
-                tilefile = os.path.join(tiledir, "%s.%s" % (ty, options.get('format').lower()))
-                if options.get('resume') and os.path.exists(tilefile):
-                    logger.debug("Skip existing tile: %s", tilefile)
+                tilefiles = [tile_path(variant, tx, ty, tz) for variant in variants]
+                if options.get('resume') and all(os.path.exists(tilefile) for tilefile in tilefiles):
+                    logger.debug("Skip existing tile: %s", tilefiles[0])
+                    ranges.append([])
+                    continue
+                if len(ranges[-1]) == batch:
+                    ranges.append([])
+                ranges[-1].append(ty)
+            for tys in ranges:
+                if not tys:
                     continue
-                args = (workerfile, tilefile, tx, ty, tz, options.get('tilesize'), dataBandsCount)
-                kwargs = {'driver': options.get('format')}
-                logger.debug("Task: %s, %s", repr(args), repr(kwargs))
+                args = (job_id, tz, tx, tys[-1])
+                if len(tys) > 1:
+                    args += (tys[0],)
+                cost = 0
+                if options.get('heavy_queue'):
+                    cost = sum(read_cost(tx, ty, tz) for ty in tys)
+                routing = route(cost, len(tys), **options)
+                logger.debug("Task: %s, %s", repr(args), repr(routing))
                 if not options.get('dry_run'):
-                    tr.apply_async(args, kwargs)
+                    jtr.apply_async(args, **routing)
 
 
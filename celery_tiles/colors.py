@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c) 2013, Michael Fladischer <FladischerMichael@fladi.at>
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#******************************************************************************
+
+
+from __future__ import absolute_import
+
+def palette(colortable):
+    """Returns the entries of a GDAL color table as a colormap suitable for
+    colorize()."""
+    return {'palette': [list(colortable.GetColorEntry(i)) for i in range(colortable.GetCount())]}
+
+def parse_ramp(filename):
+    """Parses a color ramp in the text format used by gdaldem color-relief
+    and returns it as a colormap suitable for colorize(). Each line holds
+    an elevation followed by R G B and an optional alpha value. The
+    elevation 'nv' sets the color for NODATA pixels, which defaults to
+    transparent. Colors between the elevations are interpolated linearly."""
+
+    stops = []
+    nodata = [0, 0, 0, 0]
+    with open(filename) as f:
+        for line in f:
+            parts = line.replace(',', ' ').replace(':', ' ').split()
+            if not parts or parts[0].startswith('#'):
+                continue
+            color = [int(c) for c in parts[1:]]
+            if len(color) == 3:
+                color.append(255)
+            if len(color) != 4:
+                raise ValueError("Invalid color ramp entry: %s" % line.strip())
+            if parts[0].lower() == 'nv':
+                nodata = color
+            else:
+                stops.append([float(parts[0])] + color)
+    if not stops:
+        raise ValueError("Color ramp %s has no entries." % filename)
+    stops.sort()
+    return {'ramp': stops, 'nodata': nodata}
+
+def colorize(array, mask, colormap, nodata=None):
+    """Maps the single band array to RGBA by either looking up a palette or
+    interpolating a ramp from colormap. mask is the alpha band for array as
+    read from GDAL. Returns the RGB bands as band sequential bytes and the
+    alpha band as bytes, the same way ReadRaster() would have."""
+
+    import numpy
+
+    if 'palette' in colormap:
+        lut = numpy.array(colormap['palette'], dtype=numpy.uint8)
+        rgba = numpy.take(lut, array, axis=0, mode='clip')
+    else:
+        stops = numpy.array(colormap['ramp'], dtype=numpy.float64)
+        rgba = numpy.empty(array.shape + (4,), dtype=numpy.uint8)
+        for i in range(4):
+            rgba[..., i] = numpy.interp(array, stops[:, 0], stops[:, i+1])
+
+    alpha = numpy.minimum(numpy.frombuffer(mask, dtype=numpy.uint8).reshape(array.shape), rgba[..., 3])
+
+    if nodata is not None and 'nodata' in colormap:
+        if nodata != nodata:
+            invalid = numpy.isnan(array)
+        else:
+            invalid = array == nodata
+        rgba[invalid] = colormap['nodata']
+        alpha[invalid] = colormap['nodata'][3]
+
+    return rgba[..., :3].transpose(2, 0, 1).tobytes(), alpha.tobytes()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c) 2013, Michael Fladischer <FladischerMichael@fladi.at>
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#******************************************************************************
+
+
+from __future__ import absolute_import
+
+import os
+import json
+import uuid
+import tempfile
+
+# Celery setting for the directory holding job descriptors. Workers on other
+# nodes need access to it, so for distributed setups it should point to
+# shared storage.
+JOB_DIR_SETTING = 'CELERY_TILES_JOB_DIR'
+
+# Number of job descriptors a worker process keeps in memory
+MAX_CACHED_JOBS = 16
+
+_jobs = {}
+
+def job_dir(app):
+    """Returns the directory for job descriptors configured for app."""
+    return app.conf.get(JOB_DIR_SETTING) or tempfile.gettempdir()
+
+def save_job(directory, job):
+    """Stores the job descriptor job (a JSON serializable dict) in directory
+    and returns the new job ID."""
+    job_id = uuid.uuid4().hex
+    filename = os.path.join(directory, "%s.job" % job_id)
+    # Write to a temporary file first, so workers never see a partial job.
+    tmp = "%s.tmp" % filename
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.rename(tmp, filename)
+    return job_id
+
+def load_job(directory, job_id):
+    """Returns the job descriptor for job_id from directory. Descriptors
+    are cached per process, as they never change once saved."""
+    if job_id not in _jobs:
+        if len(_jobs) >= MAX_CACHED_JOBS:
+            _jobs.clear()
+        with open(os.path.join(directory, "%s.job" % job_id)) as f:
+            _jobs[job_id] = json.load(f)
+    return _jobs[job_id]
+
+def tile_path(variant, tx, ty, tz):
+    """Returns the TMS path of the tile tx/ty/tz below the output of a job
+    variant."""
+    return os.path.join(variant['output'], str(tz), str(tx), "%s.%s" % (ty, variant['format'].lower()))
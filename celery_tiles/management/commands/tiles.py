@@ -94,6 +94,74 @@ class Command(BaseCommand):
             type='string',
             help='GDAL input SRS.',
         ),
+        make_option('-b', '--batch',
+            action='store',
+            dest='batch',
+            type='int',
+            default=1,
+            help='Number of tiles from the same column to render in a single task.',
+        ),
+        make_option('-c', '--color-ramp',
+            action='store',
+            dest='color_ramp',
+            type='string',
+            default=None,
+            help='Color ramp (gdaldem color-relief format) to apply to single band input.',
+        ),
+        make_option('-q', '--queue',
+            action='store',
+            dest='queue',
+            type='string',
+            default=None,
+            help='Queue for regular tasks.',
+        ),
+        make_option('-p', '--priority',
+            action='store',
+            dest='priority',
+            type='int',
+            default=None,
+            help='Priority for regular tasks.',
+        ),
+        make_option('-Q', '--heavy-queue',
+            action='store',
+            dest='heavy_queue',
+            type='string',
+            default=None,
+            help='Queue for tasks reading large parts of the input file.',
+        ),
+        make_option('-P', '--heavy-priority',
+            action='store',
+            dest='heavy_priority',
+            type='int',
+            default=None,
+            help='Priority for tasks in the heavy queue.',
+        ),
+        make_option('-H', '--heavy-cost',
+            action='store',
+            dest='heavy_cost',
+            type='int',
+            default=16,
+            help='Tasks whose tiles read on average more than this many times the pixels of a tile are sent to the heavy queue.',
+        ),
+        make_option('-T', '--tiled',
+            action='store_true',
+            dest='tiled',
+            help='Convert the input to a tiled GeoTIFF with overviews matching the tile grid before dispatching tasks.',
+        ),
+        make_option('-m', '--max-memory',
+            action='store',
+            dest='max_memory',
+            type='int',
+            default=256,
+            help='Memory in MB a single tile may use for reading the input, 0 for no limit.',
+        ),
+        make_option('-V', '--variant',
+            action='append',
+            dest='variant',
+            type='string',
+            default=None,
+            help='Additional output variant as FORMAT:TILESIZE[:DIR], rendered from the same reads. May be given multiple times.',
+        ),
     )
     help = 'Fans out celery tasks to generate TMS tile images from GDAL input for EPSG:3857.'
 
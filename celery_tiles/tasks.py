@@ -27,13 +27,22 @@ from __future__ import absolute_import
 
 import warnings
 import logging
+import math
 import subprocess
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from osgeo import gdal
 
 from celery import Task
 
 from celery_tiles.utils import GlobalMercator
+from celery_tiles.jobs import job_dir, load_job, tile_path
+from celery_tiles.colors import colorize
 
 logger = logging.getLogger(__name__)
 
@@ -47,8 +56,16 @@ class TileRenderer(Task):
         gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO")
         self.mem_drv = gdal.GetDriverByName('MEM')
 
-    def run(self, inputfile, tilefile, tx, ty, tz, tilesize, bands, driver='PNG', optimize=False, overviews=False):
+    def run(self, inputfile, tilefile, tx, ty, tz, tilesize, bands, driver='PNG', optimize=False, overviews=False, colormap=None, max_memory=0):
         logger.info('Preparing: %s', tilefile)
+        out_drv = self.get_driver(driver)
+        ds = self.open(inputfile)
+        tile = self.read_tile(ds, tx, ty, tz, tilesize, bands, overviews, colormap, max_memory)
+        dstile = self.render_tile(tile, tilesize, 3 if colormap else bands, self.alpha_band(out_drv))
+        del tile
+        self.write_tile(out_drv, dstile, tilefile, optimize)
+
+    def get_driver(self, driver):
         # Initialize necessary GDAL drivers
         if not self.mem_drv:
             raise Exception("The 'MEM' driver was not found, is it available in this GDAL build?")
@@ -56,7 +73,9 @@ class TileRenderer(Task):
         out_drv = gdal.GetDriverByName(driver)
         if not out_drv:
             raise Exception("The '%s' driver was not found, is it available in this GDAL build?", driver)
+        return out_drv
 
+    def open(self, inputfile):
         ds = gdal.Open(inputfile, gdal.GA_ReadOnly)
 
         if not ds:
@@ -64,7 +83,15 @@ class TileRenderer(Task):
 
         logger.debug("Preprocessed file: %s ( %sP x %sL - %s bands)", inputfile, ds.RasterXSize, ds.RasterYSize, ds.RasterCount)
         logger.debug("Input projection: %s", ds.GetProjection())
+        return ds
 
+    def read_tile(self, ds, tx, ty, tz, tilesize, bands, overviews=False, colormap=None, max_memory=0):
+        """Reads the source window for a single tile from ds and returns
+        a tuple of (data, alpha, rb, wb, querysize) that can be passed on
+        to render_tile(). If a colormap is given, only the first band is
+        read and the data returned holds three RGB bands. If max_memory is
+        given, the window is read at a reduced resolution so that the
+        buffers for the tile stay within max_memory bytes."""
 
         mercator = GlobalMercator(tilesize=tilesize)
 
@@ -72,7 +99,14 @@ class TileRenderer(Task):
 
         logger.debug("TileBounds: minx=%f miny=%f maxx=%f maxy=%f", *b)
 
-        rb, wb = self.geo_query(ds, *b)
+        if not overviews:
+            querysize = self.query_size(ds, b[2] - b[0], tilesize, bands, max_memory, colormap)
+        else:
+            # Read at the size of the tile, which lets GDAL pick the
+            # matching overview level of the input file.
+            querysize = tilesize
+
+        rb, wb = self.geo_query(ds, *b, querysize=querysize)
 
         # Tile bounds in raster coordinates for ReadRaster query
         rx, ry, rxsize, rysize = rb
@@ -80,61 +114,118 @@ class TileRenderer(Task):
 
         logger.debug("ReadRaster Extent: rx:%d ry:%d rxsize:%d rysize:%d wx:%d wy:%d wxsize:%d wysize:%d", rx, ry, rxsize, rysize, wx, wy, wxsize, wysize)
 
+        # Read data and alpha band
+        alphaband = ds.GetRasterBand(1).GetMaskBand()
+        logger.debug("Reading alpha band raster: %s", (rx, ry, rxsize, rysize, wxsize, wysize))
+        alpha = alphaband.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize)
+        logger.debug("Reading data band raster: %s", (rx, ry, rxsize, rysize, wxsize, wysize))
+        if colormap:
+            # Only the single source band is read, colors are applied per tile.
+            band = ds.GetRasterBand(1)
+            array = band.ReadAsArray(rx, ry, rxsize, rysize, wxsize, wysize)
+            data, alpha = colorize(array, alpha, colormap, band.GetNoDataValue())
+            del array
+        else:
+            data = ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize, band_list=list(range(1, bands+1)))
+
+        return data, alpha, rb, wb, querysize
+
+    def query_size(self, ds, width, tilesize, bands, max_memory=0, colormap=None):
+        """Returns the size of the buffer a tile of the given width in
+        cartographic coordinates is read into from ds. This is the native
+        resolution of ds, reduced to fit into max_memory bytes if given, but
+        never below the tilesize."""
+
+        querysize = int(width / ds.GetGeoTransform()[1] + 0.5)
+        if max_memory:
+            size = gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8
+            if colormap:
+                # The band and its mask as read, the float64 interpolation
+                # temporary, the RGBA array, the alpha and the RGB bytes of
+                # colorize() and the four bands of the dataset resampled from.
+                pixel = size + 1 + 8 + 4 + 1 + 4 + 4
+            else:
+                # The bands and their mask as read and the dataset they are
+                # resampled from.
+                pixel = bands * size + 1 + bands + 1
+            limit = int(math.sqrt(max_memory / float(pixel)))
+            if querysize > limit:
+                logger.debug("Limiting querysize from %d to %d", querysize, max(limit, tilesize))
+                querysize = max(limit, tilesize)
+        return querysize
+
+    def render_tile(self, tile, tilesize, bands, alpha_band=True):
+        """Resamples the result of read_tile() into a tile dataset in
+        memory. The alpha band is left out if alpha_band is False."""
+
+        return self.render_tiles(tile, bands, [(tilesize, alpha_band)])[0]
+
+    def render_tiles(self, tile, bands, variants):
+        """Resamples the result of read_tile() into a tile dataset in
+        memory for each (tilesize, alpha_band) in variants. The buffer to
+        resample from is only built once for all of them."""
+
+        data, alpha, rb, wb, querysize = tile
+        rx, ry, rxsize, rysize = rb
+        wx, wy, wxsize, wysize = wb
+
         # Query is in 'nearest neighbour' but can be bigger in then the tilesize
         # We scale down the query to the tilesize by supplied algorithm.
 
-        # Tile dataset in memory
         band_list = list(range(1, bands+1))
-        dstile = self.mem_drv.Create('', tilesize, tilesize, bands+1)
-
-        # Not implemented yet, therefor always uses reprojection.
-        if not overviews:
 
-            # Read data and alpha band
-            logger.debug("Reading data band raster: %s", (rx, ry, rxsize, rysize, wxsize, wysize))
-            data = ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize, band_list=band_list)
-            alphaband = ds.GetRasterBand(1).GetMaskBand()
-            logger.debug("Reading alpha band raster: %s", (rx, ry, rxsize, rysize, wxsize, wysize))
-            alpha = alphaband.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize)
+        dsquery = None
+        if any(tilesize != querysize for tilesize, alpha_band in variants):
 
             # Create empty buffer to write to
-            dsquery = self.mem_drv.Create('', wxsize, wysize, bands+1)
+            dsquery = self.mem_drv.Create('', querysize, querysize, bands+1)
 
             logger.debug("Writing data band raster: %s", (wx, wy, wxsize, wysize))
             dsquery.WriteRaster(wx, wy, wxsize, wysize, data, band_list=band_list)
             logger.debug("Writing alpha band raster: %s", (wx, wy, wxsize, wysize))
             dsquery.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[bands+1])
 
-            dsquery.SetGeoTransform( (0.0, tilesize / float(rxsize), 0.0, 0.0, 0.0, tilesize / float(rysize)) )
-            dstile.SetGeoTransform( (0.0, 1.0, 0.0, 0.0, 0.0, 1.0) )
+        dstiles = []
+        for tilesize, alpha_band in variants:
+            # Tile dataset in memory
+            dstile = self.mem_drv.Create('', tilesize, tilesize, bands+1)
 
-            logger.debug('Reprojecting ...')
-            res = gdal.ReprojectImage(dsquery, dstile, None, None, gdal.GRA_NearestNeighbour)
+            if tilesize != querysize:
+                dsquery.SetGeoTransform( (0.0, tilesize / float(querysize), 0.0, 0.0, 0.0, tilesize / float(querysize)) )
+                dstile.SetGeoTransform( (0.0, 1.0, 0.0, 0.0, 0.0, 1.0) )
 
-        else:
-            tilesizex = int(wxsize/float(wx+wxsize)*tilesize)
-            tilesizey = int(wysize/float(wy+wysize)*tilesize)
-            logger.debug("Cropped Tilesize: x=%d y=%d", tilesizex, tilesizey)
-            logger.debug("Reading data band raster: %s", (rx, ry, rxsize, rysize, wxsize, wysize))
-            data = ds.ReadRaster(rx, ry, rxsize, rysize, band_list=band_list, buf_xsize=tilesizex, buf_ysize=tilesizey)
-            alphaband = ds.GetRasterBand(1).GetMaskBand()
-            logger.debug("Reading alpha band raster: %s", (rx, ry, rxsize, rysize, wxsize, wysize))
-            alpha = alphaband.ReadRaster(rx, ry, rxsize, rysize, buf_xsize=tilesizex, buf_ysize=tilesizey)
-
-            # Use the ReadRaster result directly in tiles ('nearest neighbour' query)
-            logger.debug("Writing data band raster: %s", (wx, wy, wxsize, wysize))
-            dstile.WriteRaster(wx, wy, wxsize, wysize, data, band_list=band_list)
-            logger.debug("Writing alpha band raster: %s", (wx, wy, wxsize, wysize))
-            dstile.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[bands+1])
+                logger.debug('Reprojecting ...')
+                res = gdal.ReprojectImage(dsquery, dstile, None, None, gdal.GRA_NearestNeighbour)
+
+            else:
+                # Use the ReadRaster result directly in tiles ('nearest neighbour' query)
+                logger.debug("Writing data band raster: %s", (wx, wy, wxsize, wysize))
+                dstile.WriteRaster(wx, wy, wxsize, wysize, data, band_list=band_list)
+                logger.debug("Writing alpha band raster: %s", (wx, wy, wxsize, wysize))
+                dstile.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[bands+1])
+
+            if not alpha_band:
+                # Copy only the data bands of the tile
+                dsdata = self.mem_drv.Create('', tilesize, tilesize, bands)
+                dsdata.WriteRaster(0, 0, tilesize, tilesize, dstile.ReadRaster(0, 0, tilesize, tilesize, band_list=band_list), band_list=band_list)
+                dstile = dsdata
+
+            dstiles.append(dstile)
+
+        del dsquery
+
+        return dstiles
 
-        del data
-        del alpha
+    def alpha_band(self, out_drv):
+        """Returns whether tiles written by out_drv may have an alpha band.
+        JPEG writes RGBA as CMYK and refuses grey with alpha."""
+        return out_drv.ShortName != 'JPEG'
 
+    def write_tile(self, out_drv, dstile, tilefile, optimize=False):
         # Write a copy of tile to png/jpg
         logger.info('Rendering: %s', tilefile)
-        out_drv.CreateCopy(tilefile, dstile, strict=0)
-
-        del dstile
+        if not out_drv.CreateCopy(tilefile, dstile, strict=0):
+            raise Exception("Unable to write tile '%s': %s" % (tilefile, gdal.GetLastErrorMsg()))
 
         if optimize:
             logger.info('Optimizing: %s', tilefile)
@@ -142,8 +233,7 @@ class TileRenderer(Task):
 
         logger.info('Done: %s', tilefile)
 
-
-    def geo_query(self, ds, minx, miny, maxx, maxy):
+    def geo_query(self, ds, minx, miny, maxx, maxy, querysize=0):
         """For given dataset and query in cartographic coordinates
         returns parameters for ReadRaster() in raster coordinates and
         x/y shifts (for border tiles). If the querysize is not given, the
@@ -155,7 +245,10 @@ class TileRenderer(Task):
         rxsize = int((maxx - minx) / pwx + 0.5)
         rysize = int((miny - maxy) / pwy + 0.5)
 
-        wxsize, wysize = rxsize, rysize
+        if not querysize:
+            wxsize, wysize = rxsize, rysize
+        else:
+            wxsize, wysize = querysize, querysize
 
         # Coordinates should not go out of the bounds of the raster
         wx = 0
@@ -184,3 +277,132 @@ class TileRenderer(Task):
 
         return (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize)
 
+
+
+class TileBatchRenderer(TileRenderer):
+    """Base for tasks rendering a batch of tiles from the same input file.
+    Source windows are prefetched by a reader thread and finished tiles
+    are handed to a writer thread, so reading, resampling and encoding of
+    consecutive tiles overlap inside a single worker slot."""
+
+    abstract = True
+
+    # Number of tiles that may be queued between the pipeline stages
+    prefetch = 2
+
+    def pipeline(self, inputfile, tiles, read, render):
+        """Runs read(ds, tile) for each tile in a reader thread, render(tile,
+        chunk) in the calling thread and write_tile() for each of the
+        arguments returned by render() in a writer thread. The first
+        exception raised in any stage stops the pipeline and is re-raised."""
+
+        if len(tiles) == 1:
+            # Nothing to overlap for a single tile
+            ds = self.open(inputfile)
+            for args in render(tiles[0], read(ds, tiles[0])):
+                self.write_tile(*args)
+            return
+
+        reads = queue.Queue(self.prefetch)
+        writes = queue.Queue(self.prefetch)
+        errors = []
+        # Set when the calling thread leaves the pipeline early
+        stop = threading.Event()
+
+        def reader():
+            try:
+                # GDAL datasets are not thread safe, so the reader thread
+                # uses its own handle.
+                ds = self.open(inputfile)
+                for tile in tiles:
+                    if errors or stop.is_set():
+                        break
+                    reads.put((tile, read(ds, tile)))
+            except Exception as e:
+                logger.exception('Reading failed: %s', inputfile)
+                errors.append(e)
+            finally:
+                reads.put(None)
+
+        def writer():
+            while True:
+                item = writes.get()
+                if item is None:
+                    break
+                # Keep draining the queue after an error so nobody blocks.
+                if errors or stop.is_set():
+                    continue
+                try:
+                    self.write_tile(*item)
+                except Exception as e:
+                    logger.exception('Writing failed: %s', item[2])
+                    errors.append(e)
+                del item
+
+        threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        finished = False
+        try:
+            while True:
+                item = reads.get()
+                if item is None:
+                    finished = True
+                    break
+                if errors:
+                    continue
+                tile, chunk = item
+                del item
+                try:
+                    for args in render(tile, chunk):
+                        writes.put(args)
+                except Exception as e:
+                    logger.exception('Rendering failed: %s', repr(tile))
+                    errors.append(e)
+                del chunk
+        finally:
+            # If the loop was left by an exception (e.g. a soft time limit),
+            # drain the reads so the reader is not blocked on put() forever.
+            stop.set()
+            while not finished:
+                finished = reads.get() is None
+            writes.put(None)
+            for t in threads:
+                t.join()
+
+        if errors:
+            raise errors[0]
+
+
+class JobTileRenderer(TileBatchRenderer):
+    """Renders the tiles tminy to tmaxy of column tx at zoom level tz for
+    a job. All other parameters are taken from the job descriptor, which
+    keeps the task messages small. Each source window is read once at the
+    largest tilesize of all variants of the job and every variant is
+    rendered from it."""
+
+    def run(self, job_id, tz, tx, tminy, tmaxy=None):
+        job = load_job(job_dir(self.app), job_id)
+        if tmaxy is None:
+            tmaxy = tminy
+        variants = job['variants']
+        drivers = [self.get_driver(variant['format']) for variant in variants]
+        readsize = max(variant['tilesize'] for variant in variants)
+        colormap = job.get('colormap')
+        tiles = [(tx, ty, tz) for ty in range(tmaxy, tminy-1, -1)]
+
+        def read(ds, tile):
+            tx, ty, tz = tile
+            logger.info('Preparing: %d/%d/%d', tz, tx, ty)
+            return self.read_tile(ds, tx, ty, tz, readsize, job['bands'], job['overviews'], colormap, job.get('max_memory', 0))
+
+        def render(tile, chunk):
+            tx, ty, tz = tile
+            dstiles = self.render_tiles(chunk, 3 if colormap else job['bands'],
+                [(variant['tilesize'], self.alpha_band(out_drv)) for out_drv, variant in zip(drivers, variants)])
+            return [(out_drv, dstile, tile_path(variant, tx, ty, tz), job['optimize'])
+                for out_drv, dstile, variant in zip(drivers, dstiles, variants)]
+
+        self.pipeline(job['source'], tiles, read, render)